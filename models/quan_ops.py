@@ -65,13 +65,16 @@ def batchnorm1d_fn(bit_list, affine=True):
 
 
 class qfn(torch.autograd.Function):
+    # Rounding to 2**k - 1 levels needs fp32 precision, even under autocast
     @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, k):
         n = float(2**k - 1)
         out = torch.round(input * n) / n
         return out
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         grad_input = grad_output.clone()
         return grad_input, None
@@ -156,6 +156,13 @@ class PreActResNet(nn.Module):
         self.name_idx_dict = self.get_name_idx_dict()
         self.names = self.get_names()
         self.bn_layers = self.get_bn_layers()
+        # Modules reading the bit widths, so switching precision avoids a full tree walk
+        self._quant_modules = [m for m in self.modules() if hasattr(m, 'wbit') or hasattr(m, 'abit')]
+
+    def set_bits(self, wbit, abit):
+        for m in self._quant_modules:
+            m.wbit = wbit
+            m.abit = abit
 
     def forward(self, x):
         out = self.conv0(x)
@@ -177,6 +184,13 @@ class PreActResNet(nn.Module):
         out = out.mean(dim=2).mean(dim=2)
         out = self.fc(out)
         return zq_for_hp, zq_for_const, out
+
+    def forward_collect(self, x, collect=True):
+        # Single pass returning the output and, if requested, the constrained activations
+        if not collect:
+            return self.forward(x), None
+        _, zq_for_const, out = self.get_activations(x)
+        return out, zq_for_const
     
     def eval_layers(self,input, zq_for_hp):
         z = []
@@ -1,4 +1,6 @@
 import argparse
+import concurrent.futures
+import contextlib
 import os
 import time
 import socket
@@ -6,10 +8,12 @@ import logging
 from datetime import datetime
 from functools import partial
 import random
+import itertools
 import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim
 import torch.utils.data
 from torch.autograd import Variable
@@ -18,56 +22,93 @@ import models
 from models.losses import CrossEntropyLossSoft
 from datasets.data import get_dataset, get_transform
 from optimizer import get_optimizer_config, get_lr_scheduler
-from utils import setup_logging, setup_gpus, save_checkpoint
-from utils import AverageMeter, accuracy
+from utils import setup_logging, setup_gpus, save_checkpoint, state_to_cpu
+from utils import AverageMeter, CUDAPrefetcher, accuracy, meters_to_host
 
 import wandb
 
-def seed_everything(seed: int):    
+def seed_everything(seed: int, deterministic: bool = False):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # Let cuDNN autotune conv algorithms and use TF32 matmuls on Ampere+
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
 
 
 def main(args):
-    if args.wandb_log:
+    torch.multiprocessing.set_sharing_strategy('file_system')
+    # Launched with torchrun: one process per GPU, otherwise pick a single free GPU
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        torch.distributed.init_process_group('nccl')
+        rank = torch.distributed.get_rank()
+        best_gpu = int(os.environ['LOCAL_RANK'])
+    else:
+        rank = 0
+        best_gpu = setup_gpus()
+    torch.cuda.set_device(best_gpu)
+    if args.amp and not torch.cuda.is_bf16_supported():
+        logging.warning('bf16 is not supported on this GPU, training in fp32')
+        args.amp = False
+    # Only the first process logs to wandb and writes checkpoints
+    is_main = rank == 0
+
+    if args.wandb_log and is_main:
         wandb.init(project=args.project, entity="alelab", name=args.results_dir.split('/')[-1])
         wandb.config.update(args)
 
-    best_gpu = setup_gpus()
-    torch.cuda.set_device(best_gpu)
-    torch.backends.cudnn.benchmark = True
-
+    # Keep workers alive across epochs, prefetch_factor is only valid with workers
+    loader_kwargs = {}
+    if args.workers > 0:
+        loader_kwargs = dict(persistent_workers=True, prefetch_factor=args.prefetch_factor)
     train_transform = get_transform(args.dataset, 'train')
     train_data = get_dataset(args.dataset, args.train_split, train_transform)
+    train_sampler = torch.utils.data.distributed.DistributedSampler(train_data) if distributed else None
     train_loader = torch.utils.data.DataLoader(train_data,
                                                batch_size=args.batch_size,
-                                               shuffle=True,
+                                               shuffle=train_sampler is None,
+                                               sampler=train_sampler,
                                                num_workers=args.workers,
-                                               pin_memory=True)
+                                               pin_memory=True,
+                                               **loader_kwargs)
 
     val_transform = get_transform(args.dataset, 'val')
     val_data = get_dataset(args.dataset, 'val', val_transform)
+    # Each process evaluates its own shard, forward all-reduces the meters
+    val_sampler = torch.utils.data.distributed.DistributedSampler(val_data, shuffle=False) if distributed else None
     val_loader = torch.utils.data.DataLoader(val_data,
                                              batch_size=args.batch_size,
                                              shuffle=False,
+                                             sampler=val_sampler,
                                              num_workers=args.workers,
-                                             pin_memory=True)
+                                             pin_memory=True,
+                                             **loader_kwargs)
 
-    bit_width_list = list(map(int, args.bit_width_list.split(',')))
-    bit_width_list.sort()
+    bit_width_list = tuple(sorted(map(int, args.bit_width_list.split(','))))
     # Add 32 BN layers for evaluation only
     if 32 not in bit_width_list:
-        bw_list = bit_width_list + [32]
+        bw_list = list(bit_width_list) + [32]
     else:
-        bw_list = bit_width_list
+        bw_list = list(bit_width_list)
     model = models.__dict__[args.model](bw_list, train_data.num_classes).cuda()
     model.bn_to_cuda()
+    model = model.to(memory_format=torch.channels_last)
+    num_layers = model.get_num_layers()
+    if args.compile:
+        # wbit/abit are plain int attributes, so Dynamo guards on them and caches
+        # one specialized graph per bit width. Compile in place to keep state_dict keys.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4 * len(bw_list))
+        model.forward = torch.compile(model.forward, dynamic=False)
+        model.forward_collect = torch.compile(model.forward_collect, dynamic=False)
 
     lr_decay = list(map(int, args.lr_decay.split(',')))
     optimizer = get_optimizer_config(model, args.optimizer, args.lr, args.weight_decay)
@@ -100,16 +141,39 @@ def main(args):
     num_parameters = sum([l.nelement() for l in model.parameters()])
     logging.info("number of parameters: %d", num_parameters)
 
+    # Each bit width trains its own switchable BN, so every pass leaves some parameters unused
+    train_model = model
+    if distributed:
+        train_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[best_gpu],
+                                                                find_unused_parameters=True)
+
     criterion = nn.CrossEntropyLoss().cuda()
     criterion_soft = CrossEntropyLossSoft().cuda()
 
+    epsilon = {b: [args.epsilonlw for _ in range(num_layers)]+[args.epsilon_out] for b in bit_width_list}
+    if args.wandb_log and is_main:
+        wandb.config.update({"epsilon":epsilon})
+    # Kept on the GPU so slacks are computed without host to device copies
+    epsilon = {b: torch.tensor(eps, device='cuda', dtype=torch.float32) for b, eps in epsilon.items()}
+
+    # Checkpoints are written in the background while the next epoch starts
+    ckpt_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if is_main else None
+    ckpt_future = None
     for epoch in range(args.start_epoch, args.epochs):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
-        train_loss, train_prec1, train_prec5 = forward(train_loader, model, criterion, criterion_soft, epoch, args, True,
-                                                       optimizer)
+        train_loss, train_prec1, train_prec5 = forward(train_loader, train_model, criterion, criterion_soft, epoch, args, True,
+                                                       optimizer, bit_width_list=bit_width_list)
         model.eval()
-        train_loss, train_prec1, train_prec5, train_slack = forward(train_loader, model, criterion, criterion_soft, epoch, args, False)
-        val_loss, val_prec1, val_prec5, val_slack = forward(val_loader, model, criterion, criterion_soft, epoch, args, False)
+        train_slack = None
+        if args.eval_constraint:
+            # Constraint slacks on the train split are estimated on a subsample only
+            train_subset = itertools.islice(train_loader, args.eval_batches)
+            _, _, _, train_slack = forward(train_subset, model, criterion, criterion_soft, epoch, args, False,
+                                           bit_width_list=bit_width_list, epsilon=epsilon)
+        val_loss, val_prec1, val_prec5, val_slack = forward(val_loader, model, criterion, criterion_soft, epoch, args, False,
+                                                            bit_width_list=bit_width_list, epsilon=epsilon)
 
         if isinstance(lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
             lr_scheduler.step(val_loss)
@@ -122,123 +186,138 @@ def main(args):
         else:
             is_best = val_prec1[-1] > best_prec1
             best_prec1 = max(val_prec1[-1], best_prec1)
-        save_checkpoint(
-            {
+        if is_main:
+            if ckpt_future is not None:
+                ckpt_future.result()
+            # Snapshot to host memory now, so training can keep updating the GPU copies
+            state = state_to_cpu({
                 'epoch': epoch + 1,
                 'model': args.model,
                 'state_dict': model.state_dict(),
                 'best_prec1': best_prec1,
                 'optimizer': optimizer.state_dict()
-            },
-            is_best,
-            path=args.results_dir + '/ckpt')
+            })
+            ckpt_future = ckpt_executor.submit(save_checkpoint, state, is_best, path=args.results_dir + '/ckpt')
 
-        if args.wandb_log:
-            for bw, tl, tp1, tp5, tce, vl, vp1, vp5, vce in zip(bit_width_list, train_loss, train_prec1, train_prec5, train_ce, val_loss,
-                                                      val_prec1, val_prec5, val_ce):
-                wandb.log({f'train_loss_{bw}':tl, "epoch":epoch})
-                wandb.log({f'train_acc_{bw}':tp1, "epoch":epoch})
-                wandb.log({f'test_loss_{bw}':vl, "epoch":epoch})
-                wandb.log({f'test_acc_{bw}':vp1, "epoch":epoch})
-                wandb.log({f'train_CE_{bw}':tce, "epoch":epoch})
-                wandb.log({f'test_CE_{bw}':vce, "epoch":epoch})
+        if args.wandb_log and is_main:
+            # Single wandb call per epoch
+            log = {'epoch': epoch}
+            for bw, tl, tp1, vl, vp1, vsl in zip(bit_width_list, train_loss, train_prec1, val_loss, val_prec1, val_slack):
+                # Soft-target loss and train-mode accuracy of the training pass, not
+                # comparable with the train_loss_*/train_acc_* keys of older runs
+                log[f'train_distill_loss_{bw}'] = tl
+                log[f'train_distill_acc_{bw}'] = tp1
+                log[f'test_loss_{bw}'] = vl
+                log[f'test_acc_{bw}'] = vp1
+                log[f'test_CE_{bw}'] = vsl[-1]
             if args.eval_constraint:
-                for bw, tr_l2_hl, te_l2_hl \
-                in zip(bit_width_list, train_l2_hl, val_l2_hl):
-                    for l in range(model.get_num_layers()):
-                        wandb.log({f'train_l2_layer_{l}_bw_{bw}':tr_l2_hl[l], "epoch":epoch})
-                        wandb.log({f'test_l2_layer_{l}_bw_{bw}':te_l2_hl[l], "epoch":epoch})
+                for bw, tsl, vsl in zip(bit_width_list, train_slack, val_slack):
+                    log[f'train_CE_{bw}'] = tsl[-1]
+                    for l in range(num_layers):
+                        log[f'train_l2_layer_{l}_bw_{bw}'] = tsl[l]
+                        log[f'test_l2_layer_{l}_bw_{bw}'] = vsl[l]
+            wandb.log(log, step=epoch)
 
-        logging.info('Epoch {}: \ntrain loss {:.2f}, train prec1 {:.2f}, train prec5 {:.2f}\n'
-                     '  val loss {:.2f},   val prec1 {:.2f},   val prec5 {:.2f}'.format(
-                         epoch, train_loss[-1], train_prec1[-1], train_prec5[-1], val_loss[-1], val_prec1[-1],
-                         val_prec5[-1]))
+        if is_main:
+            logging.info('Epoch {}: \ntrain distill loss {:.2f}, train prec1 {:.2f}, train prec5 {:.2f}\n'
+                         '  val loss {:.2f},   val prec1 {:.2f},   val prec5 {:.2f}'.format(
+                             epoch, train_loss[-1], train_prec1[-1], train_prec5[-1], val_loss[-1], val_prec1[-1],
+                             val_prec5[-1]))
+    if ckpt_executor is not None:
+        ckpt_executor.shutdown(wait=True)
+        if ckpt_future is not None:
+            ckpt_future.result()
+    if distributed:
+        torch.distributed.destroy_process_group()
 
-def forward(data_loader, model, criterion, criterion_soft, epoch, args, training=True, optimizer=None):
-    bit_width_list = list(map(int, args.bit_width_list.split(',')))
-    bit_width_list.sort()
+def forward(data_loader, model, criterion, criterion_soft, epoch, args, training=True, optimizer=None,
+            bit_width_list=None, epsilon=None):
+    if bit_width_list is None:
+        bit_width_list = tuple(sorted(map(int, args.bit_width_list.split(','))))
     losses = [AverageMeter() for _ in bit_width_list]
     top1 = [AverageMeter() for _ in bit_width_list]
     top5 = [AverageMeter() for _ in bit_width_list]
-    slack_meter = [[AverageMeter() for _ in range(model.get_num_layers()+1)] for b in bit_width_list]
-    for i, (input, target) in enumerate(data_loader):
+    # Precision switching and activation collection live on the underlying module
+    net = model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+    is_main = (not (torch.distributed.is_available() and torch.distributed.is_initialized())
+               or torch.distributed.get_rank() == 0)
+    num_layers = net.get_num_layers()
+    # Per bit width: one meter over the vector of layer slacks and one for the output CE
+    layer_slack = [AverageMeter() for _ in bit_width_list]
+    ce_slack = [AverageMeter() for _ in bit_width_list]
+    for i, (input, target) in enumerate(CUDAPrefetcher(data_loader, memory_format=torch.channels_last)):
         if not training:
             # Just compute forward passes
             model.eval()
             with torch.no_grad():
-                input = input.cuda()
-                target = target.cuda(non_blocking=True)
-                model.apply(lambda m: setattr(m, 'wbit', bit_width_list[-1]))
-                model.apply(lambda m: setattr(m, 'abit', bit_width_list[-1]))
-                act_full = model.get_activations(input)
-                output = model(input)
-                target_soft = torch.nn.functional.softmax(output.detach(), dim=1)
-                for bw, am_l, am_t1, am_t5, slm in zip(bit_width_list, losses, top1, top5, slack_meter):
-                    model.apply(lambda m: setattr(m, 'wbit', bw))
-                    model.apply(lambda m: setattr(m, 'abit', bw))
-                    output = model(input)
+                net.set_bits(bit_width_list[-1], bit_width_list[-1])
+                output, act_full = net.forward_collect(input, collect=args.eval_constraint)
+                target_soft = F.softmax(output.detach(), dim=1)
+                for bw, am_l, am_t1, am_t5, am_ls, am_ce in zip(bit_width_list, losses, top1, top5, layer_slack, ce_slack):
+                    net.set_bits(bw, bw)
+                    output, act_q = net.forward_collect(input, collect=args.eval_constraint)
                     loss = criterion(output, target)
                     prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-                    am_l.update(loss.item(), input.size(0))
-                    am_t1.update(prec1.item(), input.size(0))
-                    am_t5.update(prec5.item(), input.size(0))
-                    act_q = model.get_activations(input)
-                    slm[-1].update(criterion_soft(output, target_soft).item(), input.size(0))
-                    for l in range(model.get_num_layers()):
-                        slack =  torch.mean(torch.square(act_q[l]-act_full[l])) - epsilon[bw][l]
-                        slm[l].update(slack.item(), input.size(0))
-                else:
-                     with torch.no_grad():
-                        model.apply(lambda m: setattr(m, 'wbit', 32))
-                        model.apply(lambda m: setattr(m, 'abit', 32))
-                        for bw, am_l, am_t1, am_t5 in zip(bit_width_list, losses, top1, top5):
-                            model.apply(lambda m: setattr(m, 'wbit', bw))
-                            model.apply(lambda m: setattr(m, 'abit', bw))
-                            output = model(input)
-                            loss = criterion(output, target)
-                            prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-                            am_l.update(loss.item(), input.size(0))
-                            am_t1.update(prec1.item(), input.size(0))
-                            am_t5.update(prec5.item(), input.size(0))
+                    am_l.update(loss, input.size(0))
+                    am_t1.update(prec1, input.size(0))
+                    am_t5.update(prec5, input.size(0))
+                    am_ce.update(criterion_soft(output, target_soft), input.size(0))
+                    if act_q is not None:
+                        # One reduction per layer, accumulated as a single vector
+                        diffs = torch.stack([F.mse_loss(aq, af, reduction='mean') for aq, af in zip(act_q, act_full)])
+                        am_ls.update(diffs - epsilon[bw][:-1], input.size(0))
         else:
-            input = input.cuda()
-            target = target.cuda(non_blocking=True)
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
+            # Slacks are only evaluated outside training, so no activations are collected here
             # train full-precision supervisor
-            model.apply(lambda m: setattr(m, 'wbit', 32))
-            model.apply(lambda m: setattr(m, 'abit', 32))
-            act_full = model.get_activations(input)
-            output = act_full[-1]
-            loss = criterion(output, target)
-            loss.backward()
-            prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-            losses[-1].update(loss.item(), input.size(0))
-            top1[-1].update(prec1.item(), input.size(0))
-            top5[-1].update(prec5.item(), input.size(0))
-            # train less-bit-wdith models
-            target_soft = torch.nn.functional.softmax(output.detach(), dim=1)
-            for bw, am_l, am_t1, am_t5, slm in zip(bit_width_list, losses, top1, top5,slack_meter):
-                model.apply(lambda m: setattr(m, 'wbit', bw))
-                model.apply(lambda m: setattr(m, 'abit', bw))
-                act_q = model.get_activations(input)
-                output = act_q[-1]
-                loss = criterion_soft(output, target_soft)
+            net.set_bits(32, 32)
+            # Under DDP gradients are only all-reduced on the last backward before the step
+            sync_free = model.no_sync if net is not model else contextlib.nullcontext
+            autocast = partial(torch.autocast, 'cuda', dtype=torch.bfloat16) if args.amp else contextlib.nullcontext
+            with sync_free():
+                # Only the forward pass is autocast, losses are computed in fp32
+                with autocast():
+                    output = model(input)
+                loss = criterion(output.float(), target)
                 loss.backward()
+            # Only the per-bit-width students are reported, the supervisor is not metered
+            # train less-bit-wdith models
+            # Teacher targets are built in fp32 and outside the graph, student outputs are released early
+            with torch.no_grad():
+                target_soft = F.softmax(output.detach().float(), dim=1)
+            del output, loss
+            for j, (bw, am_l, am_t1, am_t5) in enumerate(zip(bit_width_list, losses, top1, top5)):
+                net.set_bits(bw, bw)
+                sync_ctx = contextlib.nullcontext if j == len(bit_width_list) - 1 else sync_free
+                with sync_ctx():
+                    with autocast():
+                        output = model(input)
+                    loss = criterion_soft(output.float(), target_soft)
+                    loss.backward()
                 # recursive supervision
-                target_soft = torch.nn.functional.softmax(output.detach(), dim=1)
+                with torch.no_grad():
+                    target_soft = F.softmax(output.detach().float(), dim=1)
                 prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-                am_l.update(loss.item(), input.size(0))
-                am_t1.update(prec1.item(), input.size(0))
-                am_t5.update(prec5.item(), input.size(0))
+                am_l.update(loss, input.size(0))
+                am_t1.update(prec1, input.size(0))
+                am_t5.update(prec5, input.size(0))
+                del output, loss
             optimizer.step()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and is_main:
                 logging.info('epoch {0}, iter {1}/{2}, bit_width_max loss {3:.2f}, prec1 {4:.2f}, prec5 {5:.2f}'.format(
                     epoch, i, len(data_loader), losses[-1].val, top1[-1].val, top5[-1].val))
+    # Meters hold device tensors, read all of them back in one copy per epoch
+    k = len(bit_width_list)
+    avgs = meters_to_host(losses + top1 + top5 + layer_slack + ce_slack)
+    loss_avg, top1_avg, top5_avg = avgs[:k], avgs[k:2*k], avgs[2*k:3*k]
     if training:
-        return [_.avg for _ in losses], [_.avg for _ in top1], [_.avg for _ in top5]
+        return loss_avg, top1_avg, top5_avg
     else:
-        return [_.avg for _ in losses], [_.avg for _ in top1], [_.avg for _ in top5], [[l.avg for l in _] for _ in slack_meter]
+        # Layer slacks stay at 0 when activations are not collected
+        slack_avg = [(ls if isinstance(ls, list) else [ls] * num_layers) + [ce]
+                     for ls, ce in zip(avgs[3*k:4*k], avgs[4*k:])]
+        return loss_avg, top1_avg, top5_avg, slack_avg
 
 
 if __name__ == '__main__':
@@ -247,7 +326,8 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', default='imagenet', help='dataset name or folder')
     parser.add_argument('--train_split', default='train', help='train split name')
     parser.add_argument('--model', default='resnet18', help='model architecture')
-    parser.add_argument('--workers', default=0, type=int, help='number of data loading workers')
+    parser.add_argument('--workers', default=min(8, os.cpu_count() or 1), type=int, help='number of data loading workers')
+    parser.add_argument('--prefetch_factor', default=4, type=int, help='batches prefetched per data loading worker')
     parser.add_argument('--epochs', default=200, type=int, help='number of epochs')
     parser.add_argument('--start-epoch', default=0, type=int, help='manual epoch number')
     parser.add_argument('--batch-size', default=128, type=int, help='mini-batch size')
@@ -261,8 +341,14 @@ if __name__ == '__main__':
     parser.add_argument('--bit_width_list', default='4', help='bit width list')
     parser.add_argument('--wandb_log',  action='store_true')
     parser.add_argument('--eval_constraint',  action='store_true')
+    parser.add_argument('--epsilonlw', default=1/(2**8-1), type=float, help='layer constraint tightness')
+    parser.add_argument('--epsilon_out', default=0.1, type=float, help='output crossentropy constraint level')
+    parser.add_argument('--eval_batches', default=32, type=int, help='train batches used to evaluate constraint slacks')
     parser.add_argument('--project',  default='Baselines', type=str, help='wandb Project name')
     parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--amp', action='store_true', help='train with bf16 autocast')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile')
+    parser.add_argument('--deterministic', action='store_true', help='use deterministic cuDNN kernels (slower)')
     args = parser.parse_args()
-    seed_everything(args.seed)
+    seed_everything(args.seed, args.deterministic)
     main(args)
\ No newline at end of file
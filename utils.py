@@ -17,19 +17,85 @@ class AverageMeter:
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
     def update(self, val, n=1):
+        if torch.is_tensor(val):
+            # Accumulate on device, the host only syncs when the value is read
+            val = val.detach().float()
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        # Computed on read, so updates do not launch an extra division
+        return self.sum / self.count if self.count else 0
+
+
+def meters_to_host(meters):
+    """Read back the averages of several meters with a single device to host copy.
+    Under torch.distributed, sums and counts are all-reduced across processes first.
+    Meters averaging a vector are returned as lists.
+    """
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    device = next((m.sum.device for m in meters if torch.is_tensor(m.sum)), None)
+    if device is None:
+        device = torch.device('cuda', torch.cuda.current_device()) if distributed else torch.device('cpu')
+    sums = [torch.as_tensor(m.sum, dtype=torch.float32, device=device) for m in meters]
+    counts = torch.tensor([float(m.count) for m in meters], device=device)
+    flat = torch.cat([t.reshape(-1) for t in sums] + [counts])
+    if distributed:
+        torch.distributed.all_reduce(flat)
+    flat = flat.cpu().tolist()
+    res, idx = [], 0
+    for t, count in zip(sums, flat[-len(meters):]):
+        total = flat[idx:idx + t.numel()]
+        idx += t.numel()
+        avg = [x / count for x in total] if count else [0.0] * len(total)
+        res.append(avg[0] if t.dim() == 0 else avg)
+    return res
+
+
+class CUDAPrefetcher:
+    """Copies the next batch to the GPU on a side stream while the current one is processed.
+    Adapted from https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+    """
+    def __init__(self, loader, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            input, target = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            input = input.cuda(non_blocking=True).contiguous(memory_format=self.memory_format)
+            target = target.cuda(non_blocking=True)
+        return input, target
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            input, target = batch
+            # Tensors were allocated on the side stream but are consumed on the current one
+            input.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+            batch = self._preload(it)
+            yield input, target
 
 
 def accuracy(output, target, topk=(1, )):
     """Adapted from https://github.com/pytorch/examples/blob/master/imagenet/main.py
+    Returns tensors on the device of output, no host sync is done here.
     """
     with torch.no_grad():
         maxk = max(topk)
@@ -73,11 +139,26 @@ def setup_gpus():
     return best_gpu
 
 
+def state_to_cpu(state):
+    """Copy the tensors of a (nested) state dict to host memory.
+    """
+    if torch.is_tensor(state):
+        # Always copy, CPU tensors (e.g. Adam step counters) are still updated in place
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
 def save_checkpoint(state, is_best, path, name='model_latest.pth.tar'):
     if not os.path.exists(path):
         os.makedirs(path)
     save_path = path + '/' + name
-    torch.save(state, save_path)
+    # Large write buffer, the checkpoint is streamed in one go
+    with open(save_path, 'wb', buffering=4 << 20) as f:
+        torch.save(state, f)
     logging.info('checkpoint saved to {}'.format(save_path))
     if is_best:
         shutil.copyfile(save_path, path + '/model_best.pth.tar')